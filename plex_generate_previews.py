@@ -3,14 +3,12 @@ import sys
 import re
 import subprocess
 import shutil
-import glob
 import os
 import struct
 import urllib3
-import array
 import time
-from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from dotenv import load_dotenv
 
@@ -43,12 +41,6 @@ try:
 except ImportError:
     print('Dependencies Missing!  Please run "pip3 install pymediainfo".')
     sys.exit(1)
-try:
-    import gpustat
-except ImportError:
-    print('Dependencies Missing!  Please run "pip3 install gpustat".')
-    sys.exit(1)
-
 try:
     import requests
 except ImportError:
@@ -97,6 +89,28 @@ logger.add(
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# FFmpeg video filters. These only depend on the settings above so are built once
+VF_FPS = 'fps=fps={}:round=up'.format(round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
+VF_HDR_TONEMAP = 'zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p'
+VF_SCALE = 'scale=w=320:h=240:force_original_aspect_ratio=decrease'
+VF_SCALE_VAAPI = 'format=nv12|vaapi,hwupload,scale_vaapi=w=320:h=240:force_original_aspect_ratio=decrease'
+
+# Full -vf argument keyed by (hdr, vaapi)
+VF_PARAMETERS = {
+    (False, False): ','.join([VF_FPS, VF_SCALE]),
+    (True, False): ','.join([VF_FPS, VF_HDR_TONEMAP, VF_SCALE]),
+    (False, True): ','.join([VF_FPS, VF_SCALE_VAAPI]),
+    (True, True): ','.join([VF_FPS, VF_HDR_TONEMAP, VF_SCALE_VAAPI]),
+}
+
+# Matches the speed=...x stat FFmpeg prints on stderr
+FFMPEG_SPEED_RE = re.compile('speed= ?([0-9]+\\.?[0-9]*|\\.[0-9]+)x')
+
+# Per-process state for the preview workers, set once by init_worker() so tasks only need to carry the item key
+worker_gpu = None
+worker_gpu_slots = None
+worker_plex = None
+
 
 def detect_gpu():
     # Check for NVIDIA GPUs
@@ -136,86 +150,68 @@ def detect_gpu():
         logger.warning(f"Error initializing AMD GPU detection: {e}. AMD GPUs will not be detected.")
 
 
-def get_amd_ffmpeg_processes():
-    from amdsmi import amdsmi_init, amdsmi_shut_down, amdsmi_get_processor_handles, amdsmi_get_gpu_process_list
-    try:
-        amdsmi_init()
-        gpu_handles = amdsmi_get_processor_handles()
-        ffmpeg_processes = []
+def acquire_gpu_slot():
+    """
+    Reserve one of the GPU_THREADS hardware decode slots shared by all worker processes
+    @return True if a slot was reserved, False if the item should run on the CPU instead
+    """
+    with worker_gpu_slots.get_lock():
+        if worker_gpu_slots.value < GPU_THREADS or CPU_THREADS == 0:
+            worker_gpu_slots.value += 1
+            return True
+    return False
 
-        for gpu in gpu_handles:
-            processes = amdsmi_get_gpu_process_list(gpu)
-            for process in processes:
-                if process['name'].lower().startswith('ffmpeg'):
-                    ffmpeg_processes.append(process)
 
-        return ffmpeg_processes
-    finally:
-        amdsmi_shut_down()
+def release_gpu_slot():
+    with worker_gpu_slots.get_lock():
+        worker_gpu_slots.value -= 1
 
 
 def generate_images(video_file, output_folder, gpu):
     media_info = MediaInfo.parse(video_file)
-    vf_parameters = "fps=fps={}:round=up,scale=w=320:h=240:force_original_aspect_ratio=decrease".format(
-        round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
+    hdr = False
 
     # Check if we have a HDR Format. Note: Sometimes it can be returned as "None" (string) hence the check for None type or "None" (String)
     if media_info.video_tracks:
         if media_info.video_tracks[0].hdr_format != "None" and media_info.video_tracks[0].hdr_format is not None:
-            vf_parameters = "fps=fps={}:round=up,zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p,scale=w=320:h=240:force_original_aspect_ratio=decrease".format(round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
+            hdr = True
 
     args = [
         FFMPEG_PATH, "-loglevel", "info", "-skip_frame:v", "nokey", "-threads:0", "1", "-i",
         video_file, "-an", "-sn", "-dn", "-q:v", str(THUMBNAIL_QUALITY),
         "-vf",
-        vf_parameters, '{}/img-%06d.jpg'.format(output_folder)
+        VF_PARAMETERS[(hdr, False)], '{}/img-%06d.jpg'.format(output_folder)
     ]
 
-    start = time.time()
+    start = time.monotonic()
     hw = False
 
-    if gpu == 'NVIDIA':
-        gpu_stats_query = gpustat.core.new_query()
-        logger.debug('Trying to determine how many GPU threads running')
-        if len(gpu_stats_query):
-            gpu_ffmpeg = []
-            for gpu_stats in gpu_stats_query:
-                for process in gpu_stats.processes:
-                    if 'ffmpeg' in process["command"].lower():
-                        gpu_ffmpeg.append(process["command"])
-
-            logger.debug('Counted {} ffmpeg GPU threads running'.format(len(gpu_ffmpeg)))
-            if len(gpu_ffmpeg) > GPU_THREADS:
-                logger.debug('Hit limit on GPU threads, defaulting back to CPU')
-            if len(gpu_ffmpeg) < GPU_THREADS or CPU_THREADS == 0:
-                hw = True
-                args.insert(5, "-hwaccel")
-                args.insert(6, "cuda")
-    elif gpu:
-        # Must be AMD
-        gpu_ffmpeg = get_amd_ffmpeg_processes()
-        logger.debug('Counted {} ffmpeg GPU threads running'.format(len(gpu_ffmpeg)))
-        if len(gpu_ffmpeg) > GPU_THREADS:
+    if gpu:
+        hw = acquire_gpu_slot()
+        if not hw:
             logger.debug('Hit limit on GPU threads, defaulting back to CPU')
 
-        if len(gpu_ffmpeg) < GPU_THREADS or CPU_THREADS == 0:
-            hw = True
-            args.insert(5, "-hwaccel")
-            args.insert(6, "vaapi")
-            args.insert(7, "-vaapi_device")
-            args.insert(8, gpu)
-            # Adjust vf_parameters for AMD VAAPI
-            vf_parameters = vf_parameters.replace("scale=w=320:h=240:force_original_aspect_ratio=decrease", "format=nv12|vaapi,hwupload,scale_vaapi=w=320:h=240:force_original_aspect_ratio=decrease")
-            args[args.index("-vf") + 1] = vf_parameters
-
-    logger.debug('Running ffmpeg')
-    logger.debug(' '.join(args))
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if hw and gpu == 'NVIDIA':
+        args.insert(5, "-hwaccel")
+        args.insert(6, "cuda")
+    elif hw:
+        # Must be AMD
+        args.insert(5, "-hwaccel")
+        args.insert(6, "vaapi")
+        args.insert(7, "-vaapi_device")
+        args.insert(8, gpu)
+        # Use the AMD VAAPI scaler
+        args[args.index("-vf") + 1] = VF_PARAMETERS[(hdr, True)]
 
-    # Allow time for it to start
-    time.sleep(1)
+    try:
+        logger.debug('Running ffmpeg')
+        logger.opt(lazy=True).debug('{}', lambda: ' '.join(args))
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    finally:
+        if hw:
+            release_gpu_slot()
 
-    out, err = proc.communicate()
     if proc.returncode != 0:
         err_lines = err.decode('utf-8', 'ignore').split('\n')[-5:]
         logger.error(err_lines)
@@ -225,18 +221,12 @@ def generate_images(video_file, output_folder, gpu):
     logger.debug(out)
 
     # Speed
-    end = time.time()
+    end = time.monotonic()
     seconds = round(end - start, 1)
-    speed = re.findall('speed= ?([0-9]+\\.?[0-9]*|\\.[0-9]+)x', err.decode('utf-8', 'ignore'))
+    speed = FFMPEG_SPEED_RE.findall(err.decode('utf-8', 'ignore'))
     if speed:
         speed = speed[-1]
 
-    # Optimize and Rename Images
-    for image in glob.glob('{}/img*.jpg'.format(output_folder)):
-        frame_no = int(os.path.basename(image).strip('-img').strip('.jpg')) - 1
-        frame_second = frame_no * PLEX_BIF_FRAME_INTERVAL
-        os.rename(image, os.path.join(output_folder, '{:010d}.jpg'.format(frame_second)))
-
     logger.info('Generated Video Preview for {} HW={} TIME={}seconds SPEED={}x '.format(video_file, hw, seconds, speed))
 
 
@@ -244,7 +234,7 @@ def generate_bif(bif_filename, images_path):
     """
     Build a .bif file
     @param bif_filename name of .bif file to create
-    @param images_path Directory of image files 00000001.jpg
+    @param images_path Directory of image files img-000001.jpg
     """
     magic = [0x89, 0x42, 0x49, 0x46, 0x0d, 0x0a, 0x1a, 0x0a]
     version = 0
@@ -252,47 +242,68 @@ def generate_bif(bif_filename, images_path):
     images = [img for img in os.listdir(images_path) if os.path.splitext(img)[1] == '.jpg']
     images.sort()
 
-    f = open(bif_filename, "wb")
-    array.array('B', magic).tofile(f)
-    f.write(struct.pack("<I", version))
-    f.write(struct.pack("<I", len(images)))
-    f.write(struct.pack("<I", 1000 * PLEX_BIF_FRAME_INTERVAL))
-    array.array('B', [0x00 for x in range(20, 64)]).tofile(f)
+    # Header: magic, version, image count, frame interval (ms) then zero padding up to byte 64
+    header = [
+        bytes(magic),
+        struct.pack("<III", version, len(images), 1000 * PLEX_BIF_FRAME_INTERVAL),
+        bytes(64 - 20),
+    ]
 
     bif_table_size = 8 + (8 * len(images))
     image_index = 64 + bif_table_size
     timestamp = 0
 
     # Get the length of each image
+    index = []
     for image in images:
-        statinfo = os.stat(os.path.join(images_path, image))
-        f.write(struct.pack("<I", timestamp))
-        f.write(struct.pack("<I", image_index))
+        index.append(struct.pack("<II", timestamp, image_index))
         timestamp += 1
-        image_index += statinfo.st_size
+        image_index += os.path.getsize(os.path.join(images_path, image))
 
-    f.write(struct.pack("<I", 0xffffffff))
-    f.write(struct.pack("<I", image_index))
+    index.append(struct.pack("<II", 0xffffffff, image_index))
 
-    # Now copy the images
-    for image in images:
-        data = open(os.path.join(images_path, image), "rb").read()
-        f.write(data)
+    with open(bif_filename, "wb") as f:
+        f.write(b''.join(header + index))
 
-    f.close()
+        # Now copy the images, one at a time so the whole BIF is never held in memory
+        for image in images:
+            with open(os.path.join(images_path, image), "rb") as img:
+                shutil.copyfileobj(img, f)
 
 
-def process_item(item_key, gpu):
-    sess = requests.Session()
-    sess.verify = False
-    plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=PLEX_TIMEOUT, session=sess)
+def log_rmtree_error(func, path, exc_info):
+    # shutil.rmtree error handler: report failed cleanups rather than silently leaving frames in TMP_FOLDER
+    if not isinstance(exc_info[1], FileNotFoundError):
+        logger.warning('Failed to remove temporary files at {}. `{}:{}`'.format(path, exc_info[0].__name__, str(exc_info[1])))
 
-    data = plex.query('{}/tree'.format(item_key))
 
-    def sanitize_path(path):
-        if os.name == 'nt':
-            path = path.replace('/', '\\')
-        return path
+def sanitize_path(path):
+    if os.name == 'nt':
+        path = path.replace('/', '\\')
+    return path
+
+
+def init_worker(gpu, gpu_slots):
+    global worker_gpu, worker_gpu_slots
+    worker_gpu = gpu
+    worker_gpu_slots = gpu_slots
+
+
+def get_worker_plex():
+    # Connect lazily and reuse the connection for every item this worker process handles
+    global worker_plex
+    if worker_plex is None:
+        sess = requests.Session()
+        sess.verify = False
+        worker_plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=PLEX_TIMEOUT, session=sess)
+    return worker_plex
+
+
+def process_item(item_key):
+    gpu = worker_gpu
+    plex = get_worker_plex()
+
+    data = plex.query('{}/tree'.format(item_key))
 
     for media_part in data.findall('.//MediaPart'):
         if 'hash' in media_part.attrib:
@@ -314,12 +325,12 @@ def process_item(item_key, gpu):
                 continue
 
             bundle_path = sanitize_path(os.path.join(PLEX_LOCAL_MEDIA_PATH, 'localhost', bundle_file))
-            indexes_path = sanitize_path(os.path.join(bundle_path, 'Contents', 'Indexes'))
-            index_bif = sanitize_path(os.path.join(indexes_path, 'index-sd.bif'))
+            indexes_path = os.path.join(bundle_path, 'Contents', 'Indexes')
+            index_bif = os.path.join(indexes_path, 'index-sd.bif')
             tmp_path = sanitize_path(os.path.join(TMP_FOLDER, bundle_hash))
 
             if not os.path.isfile(index_bif):
-                logger.debug('Generating bundle_file for {} at {}'.format(media_file, index_bif))
+                logger.debug('Generating bundle_file for {} at {}', media_file, index_bif)
 
                 if not os.path.isdir(indexes_path):
                     try:
@@ -329,8 +340,7 @@ def process_item(item_key, gpu):
                         continue
 
                 try:
-                    if not os.path.isdir(tmp_path):
-                        os.makedirs(tmp_path)
+                    os.makedirs(tmp_path, exist_ok=True)
                 except OSError as e:
                     logger.error('Error generating images for {}. `{}:{}` error when creating tmp path {}'.format(media_file, type(e).__name__, str(e), tmp_path))
                     continue
@@ -339,8 +349,7 @@ def process_item(item_key, gpu):
                     generate_images(media_file, tmp_path, gpu)
                 except Exception as e:
                     logger.error('Error generating images for {}. `{}: {}` error when generating images'.format(media_file, type(e).__name__, str(e)))
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
+                    shutil.rmtree(tmp_path, onerror=log_rmtree_error)
                     continue
 
                 try:
@@ -352,8 +361,7 @@ def process_item(item_key, gpu):
                     logger.error('Error generating images for {}. `{}:{}` error when generating bif'.format(media_file, type(e).__name__, str(e)))
                     continue
                 finally:
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
+                    shutil.rmtree(tmp_path, onerror=log_rmtree_error)
 
 
 def run(gpu):
@@ -363,24 +371,38 @@ def run(gpu):
 
     plex = PlexServer(PLEX_URL, PLEX_TOKEN, session=sess)
 
-    for section in plex.library.sections():
-        logger.info('Getting the media files from library \'{}\''.format(section.title))
-
-        if section.METADATA_TYPE == 'episode':
-            media = [m.key for m in section.search(libtype='episode')]
-        elif section.METADATA_TYPE == 'movie':
-            media = [m.key for m in section.search()]
-        else:
-            logger.info('Skipping library {} as \'{}\' is unsupported'.format(section.title, section.METADATA_TYPE))
-            continue
+    # Number of ffmpeg processes currently decoding on the GPU, shared by every worker
+    gpu_slots = multiprocessing.Value('i', 0)
+
+    # One pool for the whole run so worker processes (and their Plex connections) are reused across libraries
+    with ProcessPoolExecutor(max_workers=CPU_THREADS + GPU_THREADS, initializer=init_worker, initargs=(gpu, gpu_slots)) as process_pool:
+        for section in plex.library.sections():
+            logger.info('Getting the media files from library \'{}\''.format(section.title))
+
+            # Longest items first (sorted by Plex), so the library doesn't finish waiting on one long item started last
+            if section.METADATA_TYPE == 'episode':
+                media = [m.key for m in section.search(libtype='episode', sort='duration:desc')]
+            elif section.METADATA_TYPE == 'movie':
+                media = [m.key for m in section.search(sort='duration:desc')]
+            else:
+                logger.info('Skipping library {} as \'{}\' is unsupported'.format(section.title, section.METADATA_TYPE))
+                continue
 
-        logger.info('Got {} media files for library {}'.format(len(media), section.title))
+            logger.info('Got {} media files for library {}'.format(len(media), section.title))
 
-        with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
-            with ProcessPoolExecutor(max_workers=CPU_THREADS + GPU_THREADS) as process_pool:
-                futures = [process_pool.submit(process_item, key, gpu) for key in media]
-                for future in progress.track(futures):
-                    future.result()
+            with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
+                futures = [process_pool.submit(process_item, key) for key in media]
+                task = progress.add_task('Working...', total=len(futures))
+                try:
+                    # Advance as items finish rather than in submission order, so one slow item doesn't stall the bar
+                    for future in as_completed(futures):
+                        future.result()
+                        progress.advance(task)
+                except BaseException:
+                    # On error or Ctrl-C drop the queued items and wait for the running ones, so nothing is still
+                    # writing to TMP_FOLDER when it gets cleaned up
+                    process_pool.shutdown(wait=True, cancel_futures=True)
+                    raise
 
 
 if __name__ == '__main__':
@@ -405,6 +427,14 @@ if __name__ == '__main__':
         logger.error('Please set the PLEX_TOKEN environment variable')
         exit(1)
 
+    # Each worker keeps roughly one core busy, so more workers than usable CPUs just fight over them
+    if hasattr(os, 'sched_getaffinity'):
+        available_cpus = len(os.sched_getaffinity(0))
+    else:
+        available_cpus = os.cpu_count() or 1
+    if CPU_THREADS + GPU_THREADS > available_cpus:
+        logger.warning('CPU_THREADS ({}) + GPU_THREADS ({}) is more than the {} CPUs available, consider lowering them'.format(CPU_THREADS, GPU_THREADS, available_cpus))
+
     # detect GPU's
     gpu = detect_gpu()
     if gpu == 'NVIDIA':